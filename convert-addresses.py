@@ -13,16 +13,38 @@ The output will be named "bev_addressesEPSGxxxx.csv".
 """
 
 requestsModule = False
+resourceModule = False
+numpyModule = False
+arrowModule = False
 osgeoModule = False
 pyprojModule = False
 arcpyModule = False
 
 from collections import defaultdict
+from contextlib import contextmanager
 import time
 print( time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()) )
 import sys
 import csv
 import argparse
+import json
+import cProfile
+try:
+    import resource
+    resourceModule = True
+except ImportError:
+    print("- no module named resource, peak memory usage will not be recorded in the metrics\n")
+try:
+    import numpy
+    numpyModule = True
+except ImportError:
+    pass
+try:
+    import pyarrow
+    import pyarrow.ipc
+    arrowModule = True
+except ImportError:
+    pass
 try:
     import requests
     requestsModule = True
@@ -32,6 +54,17 @@ import os.path
 import xml.etree.cElementTree as ET
 import operator
 import zipfile
+import zlib
+import struct
+import functools
+import threading
+import gzip
+import heapq
+import array
+import multiprocessing
+import queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 try:
     from osgeo import osr
     from osgeo import ogr
@@ -53,28 +86,67 @@ except ImportError:
 
 # command line arguments are evaluated
 parser = argparse.ArgumentParser(prog='python3 convert-addresses.py')
+parser.add_argument('command', nargs='?', default='convert', choices=['convert', 'merge'],
+                    help='''convert (default) processes the BEV data, merge combines the partial outputs of -shard runs given by their manifests into the output of a single run.''')
+parser.add_argument('manifests', nargs='*',
+                    help='''The shard manifests (results/shard_i_of_N.json) to merge. If none are given, all manifests found in results/ are used.''')
 parser.add_argument('-epsg', type=int, default=3035, dest='epsg',
                     help='Specify the EPSG code of the coordinate  system used for the results. If none is given, this value defaults to EPSG:3035')
 parser.add_argument('-sort', default=None, dest='sort',
-                    help='Specify if and by which fields the output should be sorted (possible values: gemeinde, plz, strasse, nummer, hausname, x, y, gkz).')
+                    help='Specify if and by which fields the output should be sorted (possible values: gemeinde, plz, strasse, nummer, hausname, x, y, gkz), or use hilbert or morton to sort the output rows along a space-filling curve.')
 parser.add_argument('-compatibility_mode', action='store_true', dest='compatibility_mode',
                     help='''Compatiblity mode for bev-reverse-geocoder with only one entry per address. In case of addresses with exactly one building, 
                         the building position is taken, otherwise the address position (more precisely the building position replaces the column, 
                         where bev-reverse-geocoder expected the former single position and in case of no/multiple buildings it's set equal to the address location).''')
-parser.add_argument('-output_format', default='csv', dest='output_format',
-                    help='''Specify the output format. Either csv (default) or osm. If osm is chosen, the arguments above (epsg, sort, compatibility_mode) are ignored.''')
+parser.add_argument('-output_format', default='csv', dest='output_format', choices=['csv', 'arrow', 'osm', 'osc', 'pbf'],
+                    help='''Specify the output format. Either csv (default), arrow (Arrow IPC file, requires pyarrow), osm, osc (OsmChange) or pbf (OSM PBF). If osm, osc or pbf is chosen, the arguments above (epsg, sort, compatibility_mode) are ignored.''')
+parser.add_argument('-arrow_path', default=None, dest='arrow_path',
+                    help='''Write the arrow output to the given file instead of results/bev_addressesEPSGxxxx.arrow, e.g. /dev/shm/bev_addresses.arrow to hand it to other processes through shared memory.''')
+parser.add_argument('-osm_split', default=None, dest='osm_split', choices=['street', 'gemeinde', 'national'],
+                    help='''Specify how osm, osc and pbf output is split into files: one file per street (default for osm and osc), one file per Gemeinde or a single file for all of Austria (default for pbf). pbf output cannot be split per street.''')
+parser.add_argument('-writer_threads', type=int, default=4, dest='writer_threads',
+                    help='''Number of threads that create the per-street osm/osc files in the background while processing continues (default 4, 0 writes synchronously).''')
 parser.add_argument('-here_be_dragons', action='store_true', dest='here_be_dragons',
                     help='''Include entries that would otherwise be filtered because they are most likely unimportant or even downright false.''')
 parser.add_argument('-only_notes', action='store_true', dest='only_notes',
                     help='''Only output entries that have either a "Hofname" or a "Gebäudebezeichnung"''')
 parser.add_argument('-debug', action='store_true', dest='debug',
                     help='''Return ALL coordinates to an address with annotations coded directly into the housenumber''')
+parser.add_argument('-pipeline', action='store_true', dest='pipeline',
+                    help='''Overlap download, extraction and parsing: the csv files are extracted while the data is downloaded, the lookup tables are loaded as soon as their files are available and GEBAEUDE.csv is parsed and reprojected in a separate process while the addresses are processed.''')
+parser.add_argument('-shard', default=None, dest='shard',
+                    help='''Only process the Gemeinden of shard i of N (given as i/N, e.g. 1/4) and write a partial output plus a manifest to results/, to be combined with the merge command.''')
+parser.add_argument('-metrics', default=None, dest='metrics',
+                    help='''Write a JSON report with wall time, CPU time, peak memory, row counts, rejection reasons and throughput of every processing stage to the given file''')
+parser.add_argument('-profile', default=None, dest='profile',
+                    help='''Run every processing stage under cProfile and dump the statistics as <stage>.prof into the given directory''')
 args = parser.parse_args()
 
-if args.output_format == 'osm':
+if args.output_format in ('osm', 'osc', 'pbf'):
     args.epsg = 4326
     args.sort = 'gkz,okz,plz,strasse,adrcd'
     args.compatibility_mode = False
+    if args.osm_split is None:
+        args.osm_split = 'national' if args.output_format == 'pbf' else 'street'
+    elif args.osm_split == 'street' and args.output_format == 'pbf':
+        print("\n##### ERROR ##### \npbf output can only be split per gemeinde or national.")
+        quit()
+
+if args.output_format == 'arrow' and not arrowModule:
+    print("\n##### ERROR ##### \nThe arrow output format requires the pyarrow module.")
+    quit()
+
+if args.shard is not None:
+    try:
+        args.shard_index, args.shard_count = [int(v) for v in args.shard.split("/")]
+    except ValueError:
+        args.shard_index = args.shard_count = 0
+    if not 1 <= args.shard_index <= args.shard_count:
+        print("\n##### ERROR ##### \nThe shard has to be given as i/N with 1 <= i <= N, e.g. -shard 1/4")
+        quit()
+
+# the arguments that determine the output and have to be the same for all shards of a run
+SHARD_ARGUMENTS = ['epsg', 'sort', 'compatibility_mode', 'output_format', 'osm_split', 'here_be_dragons', 'only_notes', 'debug']
 
 # the target EPSG is set according to the argument
 if not arcpyModule:
@@ -101,6 +173,9 @@ else:
     arcCenterRef = arcpy.SpatialReference(31255)
     arcEastRef = arcpy.SpatialReference(31256)
 
+ZIP_FILENAME = 'Adresse_Relationale_Tabellen-Stichtagsdaten.zip'
+CSV_FILES = ["STRASSE.csv", "GEMEINDE.csv", "ADRESSE.csv", "GEBAEUDE.csv", "ORTSCHAFT.csv"]
+
 BUNDESLAND = {
     "1": "Burgenland",
     "2": "Kärnten",
@@ -243,45 +318,184 @@ class CsvWriter():
                 os.makedirs(directory)
         self.address_writer = csv.DictWriter(open(os.path.join(directory, output_filename), 'w'), header_row, delimiter=";", quotechar='"')
         self.address_writer.writeheader()
+        self.rows_written = 0
 
     def add_address(self, address):
         self.address_writer.writerow(address)
+        self.rows_written += 1
 
     def close(self):
         self.address_writer = None
 
+class ArrowWriter():
+    """Writes the output rows as Arrow IPC file in record batches of
+    `batch_size` rows. The columns are filled directly from the address dicts:
+    gemeinde, ortschaft and strasse are dictionary encoded with dictionaries
+    that only grow, so later batches are written as dictionary deltas, and
+    the coordinates are float64. Other processes can memory map the file with
+    pyarrow.memory_map() and read the batches without copying or parsing.
+    The file is written to `output_path` if given, e.g. on a tmpfs such as
+    /dev/shm, otherwise to the usual output directory."""
+
+    DICTIONARY_COLUMNS = ("gemeinde", "ortschaft", "strasse")
+    FLOAT_COLUMNS = ("haus_x", "haus_y", "adress_x", "adress_y")
+
+    def __init__(self, output_filename, header_row, batch_size=65536, output_path=None):
+        if output_path is not None:
+            directory, output_filename = os.path.split(output_path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+        elif args.compatibility_mode:
+            directory = "./"
+        else:
+            directory = "results/"
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        self._columns = []
+        fields = []
+        for column in header_row:
+            if column in self.DICTIONARY_COLUMNS:
+                kind = "dictionary"
+                fields.append(pyarrow.field(column, pyarrow.dictionary(pyarrow.int32(), pyarrow.string())))
+            elif column in self.FLOAT_COLUMNS:
+                kind = "float"
+                fields.append(pyarrow.field(column, pyarrow.float64()))
+            elif column == "strassenname_mehrdeutig":
+                kind = "bool"
+                fields.append(pyarrow.field(column, pyarrow.bool_()))
+            else:
+                kind = "string"
+                fields.append(pyarrow.field(column, pyarrow.string()))
+            self._columns.append((column, kind))
+        self._schema = pyarrow.schema(fields)
+        self._writer = pyarrow.ipc.new_file(os.path.join(directory, output_filename), self._schema,
+                                            options=pyarrow.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+        self._dictionaries = dict((column, {}) for column in self.DICTIONARY_COLUMNS)
+        self._batch_size = batch_size
+        self._new_batch()
+        self.rows_written = 0
+
+    def _new_batch(self):
+        self._values = {}
+        for column, kind in self._columns:
+            if kind == "dictionary":
+                self._values[column] = array.array('i')
+            elif kind == "float":
+                self._values[column] = array.array('d')
+            else:
+                self._values[column] = []
+        self._batch_rows = 0
+
+    def add_address(self, address):
+        for column, kind in self._columns:
+            value = address.get(column)
+            if kind == "dictionary":
+                dictionary = self._dictionaries[column]
+                self._values[column].append(dictionary.setdefault(value, len(dictionary)))
+            elif kind == "float":
+                # NaN marks a missing coordinate and becomes null in the batch
+                self._values[column].append(float(value) if value not in (None, "") else float("nan"))
+            else:
+                self._values[column].append(value)
+        self._batch_rows += 1
+        self.rows_written += 1
+        if self._batch_rows >= self._batch_size:
+            self._write_batch()
+
+    def _write_batch(self):
+        arrays = []
+        for column, kind in self._columns:
+            values = self._values[column]
+            if kind == "dictionary":
+                indices = pyarrow.Array.from_buffers(pyarrow.int32(), len(values), [None, pyarrow.py_buffer(values)])
+                dictionary = pyarrow.array(list(self._dictionaries[column]), pyarrow.string())
+                arrays.append(pyarrow.DictionaryArray.from_arrays(indices, dictionary))
+            elif kind == "float":
+                arrays.append(pyarrow.array(values, pyarrow.float64(), from_pandas=True))
+            elif kind == "bool":
+                arrays.append(pyarrow.array(values, pyarrow.bool_()))
+            else:
+                arrays.append(pyarrow.array(values, pyarrow.string()))
+        self._writer.write_batch(pyarrow.record_batch(arrays, schema=self._schema))
+        self._new_batch()
+
+    def close(self):
+        if self._batch_rows > 0:
+            self._write_batch()
+        self._writer.close()
+
+def get_bev_date():
+    """returns the date of the BEV data as YYYY-MM-DD, taken from the zip file"""
+    z = zipfile.ZipFile(ZIP_FILENAME, 'r')
+    for f in z.infolist():
+        if f.filename == 'ADRESSE.csv':
+            return "%d-%02d-%02d" % f.date_time[:3]
+
+def get_input_fingerprint():
+    """identifies the BEV data a run used, so merge_shards() can refuse shards
+    of different releases: the size of every csv file and the BEV date if the
+    zip file is available"""
+    return {
+        "bev_date": get_bev_date() if os.path.isfile(ZIP_FILENAME) else None,
+        "sizes": dict((name, os.path.getsize(name)) for name in CSV_FILES)
+    }
+
 class OsmWriter():
-    def __init__(self):
+    """Writes the addresses as OSM nodes. Depending on `split` there is one
+    file per street, per Gemeinde or a single national file. Merged files are
+    written in chunks of `chunk_size` nodes, so they never have to be held in
+    memory completely. With `change_file` the nodes are wrapped in an
+    OsmChange <create> block instead of an <osm> document.
+    Per-street files are handed to a pool of `threads` writer threads. At most
+    `max_pending` files are queued, after that add_address() waits for the
+    oldest one to be written."""
+
+    def __init__(self, split="street", change_file=False, chunk_size=10000, threads=0, max_pending=256, bev_date=None):
+        self._split = split
+        self._change_file = change_file
+        self._chunk_size = chunk_size
         self._current_id = 0
+        self._current_group = None
         self._current_postcode = None
         self._current_gkz = None
         self._current_locality = None
         self._current_district = None
         self._current_street = None
-        self.root = None
-        self._bev_date = self._get_addr_date()
+        self._nodes = []
+        self._handle = None
+        self._directories = set()
+        self._directories_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(threads) if threads > 0 else None
+        self._pending = deque()
+        self._written = {}
+        self._max_pending = max_pending
+        self._bev_date = bev_date or get_bev_date()
         self._min_lat = None
         self._max_lat = None
         self._min_lon = None
         self._max_lon = None
+        self.rows_written = 0
 
-    def _get_addr_date(self):
-        z = zipfile.ZipFile('Adresse_Relationale_Tabellen-Stichtagsdaten.zip', 'r')
-        for f in z.infolist():
-            if f.filename == 'ADRESSE.csv':
-                return "%d-%02d-%02d" % f.date_time[:3]
+    def _get_group(self, address):
+        if self._split == "street":
+            return address["strasse"].lower()
+        elif self._split == "gemeinde":
+            return address["gkz"]
+        return "national"
 
     def add_address(self, address):
+        self.rows_written += 1
         #if self._current_locality != address["ortschaft"].lower() or self._current_postcode != address["plz"]:
-        if self._current_street != address["strasse"].lower():
-            if self.root != None:
-                self.close()
+        group = self._get_group(address)
+        if self._current_group != group:
+            if self._current_group != None:
+                self._close_group()
+            self._current_group = group
             self._current_gkz = address["gkz"]
             self._current_postcode = address["plz"]
             self._current_locality = address["ortschaft"].lower()
             self._current_district = address["gemeinde"].lower()
             self._current_street = address["strasse"].lower()
-            self.root = ET.Element("osm", version="0.6", generator="convert-addresses.py", upload="never", locked="true")
         if "haus_x" in address and str(address["haus_x"]).strip() != "":
             lat = float(address["haus_y"])
             lon = float(address["haus_x"])
@@ -302,32 +516,34 @@ class OsmWriter():
                 self._min_lon = lon
             elif lon > self._max_lon:
                 self._max_lon = lon
-        node = ET.SubElement(self.root, "node", id=self._get_id(address), lat=str(lat), lon=str(lon))
-        ET.SubElement(node, "tag", k="addr:country", v="AT")
-        ET.SubElement(node, "tag", k="at_bev:addr_date", v=self._bev_date)
-        
-        ET.SubElement(node, "tag", k="addr:postcode", v=address["plz"])
+        self._add_node(self._get_id(address), lat, lon, self._get_tags(address))
+        if self._split != "street" and len(self._nodes) >= self._chunk_size:
+            self._write_nodes()
+
+    def _get_tags(self, address):
+        tags = [("addr:country", "AT"), ("at_bev:addr_date", self._bev_date)]
+        tags.append(("addr:postcode", address["plz"]))
         streetname = address["strasse"]
         if streetname.lower().endswith("str."):
             streetname = streetname[:-1] + "aße"
         ortschaft = address["ortschaft"]
         if address["strasse"] == ortschaft:
-            ET.SubElement(node, "tag", k="addr:place", v=streetname)
+            tags.append(("addr:place", streetname))
         else:
-            ET.SubElement(node, "tag", k="addr:street", v=streetname)
+            tags.append(("addr:street", streetname))
         index_comma = ortschaft.find(",")
         if index_comma > -1:
             if ortschaft.startswith("Wien"):
-                ET.SubElement(node, "tag", k="addr:suburb", v=ortschaft[index_comma+1:])
+                tags.append(("addr:suburb", ortschaft[index_comma+1:]))
             elif ortschaft.startswith("Graz") or ortschaft.startswith("Klagenfurt"):
-                ET.SubElement(node, "tag", k="addr:suburb", v=ortschaft[index_comma+9:])
+                tags.append(("addr:suburb", ortschaft[index_comma+9:]))
             ortschaft = ortschaft[:index_comma]
         if address["strassenname_mehrdeutig"]:
-            ET.SubElement(node, "tag", k="addr:suburb", v=ortschaft)
-        ET.SubElement(node, "tag", k="addr:city", v=address["gemeinde"])
-        ET.SubElement(node, "tag", k="addr:housenumber", v=address["hausnummer"])
+            tags.append(("addr:suburb", ortschaft))
+        tags.append(("addr:city", address["gemeinde"]))
+        tags.append(("addr:housenumber", address["hausnummer"]))
         if "subadresse" in address and address["subadresse"].strip() != "":
-            ET.SubElement(node, "tag", k="addr:unit", v=address["subadresse"])
+            tags.append(("addr:unit", address["subadresse"]))
         if args.here_be_dragons or args.only_notes:
             notes = []
             if "haus_bez" in address and address["haus_bez"].strip() != "":
@@ -335,63 +551,493 @@ class OsmWriter():
             if "hausname" in address and address["hausname"].strip() != "":
                 notes.append(address["hausname"])
             if len(notes) > 0:
-                ET.SubElement(node, "tag", k="note", v=";".join(notes))
+                tags.append(("note", ";".join(notes)))
+        return tags
 
-    def close(self):
-        ET.SubElement(self.root, "bounds", minlat=str(self._min_lat), minlon=str(self._min_lon), maxlat=str(self._max_lat), maxlon=str(self._max_lon))
+    def _add_node(self, node_id, lat, lon, tags):
+        node = ET.Element("node", id=node_id, lat=str(lat), lon=str(lon))
+        for k, v in tags:
+            ET.SubElement(node, "tag", k=k, v=v)
+        node.tail = "\n"
+        self._nodes.append(node)
+
+    def _get_header(self):
+        header = "<?xml version='1.0' encoding='utf-8'?>\n"
+        if self._change_file:
+            return header + '<osmChange version="0.6" generator="convert-addresses.py">\n<create>\n'
+        return header + '<osm version="0.6" generator="convert-addresses.py" upload="never" locked="true">\n'
+
+    def _get_footer(self, bounds):
+        if self._change_file:
+            return "</create>\n</osmChange>"
+        bounds = ET.Element("bounds", minlat=str(bounds[0]), minlon=str(bounds[1]), maxlat=str(bounds[2]), maxlon=str(bounds[3]))
+        bounds.tail = "\n"
+        return ET.tostring(bounds, encoding="unicode") + "</osm>"
+
+    def _get_bounds(self):
+        bounds = (self._min_lat, self._min_lon, self._max_lat, self._max_lon)
         self._min_lat = None
         self._max_lat = None
         self._min_lon = None
         self._max_lon = None
-        self._format()
-        tree = ET.ElementTree(self.root)
-        district = "".join(c for c in self._current_district if c.isalnum())
-        locality = "".join(c for c in self._current_locality if c.isalnum())
+        return bounds
+
+    def _serialize(self, nodes):
+        return "".join(ET.tostring(node, encoding="unicode") for node in nodes)
+
+    def _open_output(self, mode='w'):
+        directory, filename = self._get_output_path()
+        self._make_directory(directory)
+        if 'b' in mode:
+            return open(os.path.join(directory, filename), mode)
+        return open(os.path.join(directory, filename), mode, encoding='utf-8')
+
+    def _make_directory(self, directory):
+        """creates the directory unless it was already created by this writer"""
+        if directory in self._directories:
+            return
+        with self._directories_lock:
+            if directory not in self._directories:
+                os.makedirs(directory, exist_ok=True)
+                self._directories.add(directory)
+
+    def _write_file(self, directory, filename, nodes, bounds, previous=None, merge=False):
+        """writes a complete file, runs on the writer threads for per-street output.
+        With `merge` the nodes are added to the ones of the existing file, after
+        waiting for the `previous` write of that file to finish"""
+        if previous is not None:
+            # submitted earlier, so it is already running on another thread
+            previous.result()
+        path = os.path.join(directory, filename)
+        if merge:
+            nodes, bounds = self._merge_existing(path, nodes, bounds)
+        self._make_directory(directory)
+        with open(path, 'w', encoding='utf-8') as handle:
+            handle.write(self._get_header() + self._serialize(nodes) + self._get_footer(bounds))
+
+    def _merge_existing(self, path, nodes, bounds):
+        """returns the nodes and bounds of an already written file combined with the given ones"""
+        root = ET.parse(path).getroot()
+        existing = list(root.iter("node"))
+        for node in existing:
+            node.tail = "\n"
+        if not self._change_file:
+            old = root.find("bounds")
+            bounds = (min(float(old.get("minlat")), bounds[0]), min(float(old.get("minlon")), bounds[1]),
+                      max(float(old.get("maxlat")), bounds[2]), max(float(old.get("maxlon")), bounds[3]))
+        return existing + nodes, bounds
+
+    def _write_nodes(self):
+        if self._handle is None:
+            self._handle = self._open_output()
+            self._handle.write(self._get_header())
+        self._handle.write(self._serialize(self._nodes))
+        self._nodes = []
+
+    def _close_group(self):
+        if self._split == "street":
+            directory, filename = self._get_output_path()
+            path = os.path.join(directory, filename)
+            # street names that only differ in case, spaces or punctuation end up in the same
+            # file, so a later group is merged into the file of the earlier one
+            merge = path in self._written
+            task = (directory, filename, self._nodes, self._get_bounds(), self._written.get(path), merge)
+            if self._executor is None:
+                self._write_file(*task)
+                self._written[path] = None
+            else:
+                if len(self._pending) >= self._max_pending:
+                    self._pending.popleft().result()
+                future = self._executor.submit(self._write_file, *task)
+                self._pending.append(future)
+                self._written[path] = future
+            self._nodes = []
+            return
+        self._write_nodes()
+        self._handle.write(self._get_footer(self._get_bounds()))
+        self._handle.close()
+        self._handle = None
+
+    def close(self):
+        if self._current_group != None:
+            self._close_group()
+        # wait for the writer threads, in submission order so errors surface deterministically
+        while self._pending:
+            self._pending.popleft().result()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def _get_output_path(self):
+        """returns directory and filename of the current group's file"""
+        district = sanitize_name(self._current_district)
+        locality = sanitize_name(self._current_locality)
         federal_state = BUNDESLAND[self._current_gkz[0]]
-        if federal_state == "Wien":
-            directory = "results/{datum}/{bundesland}/{ortschaft}".format(
+        if self._split == "national":
+            directory = "results/{datum}".format(datum = self._bev_date)
+        elif federal_state == "Wien":
+            directory = "results/{datum}/{bundesland}".format(
                 datum = self._bev_date,
-                bundesland = federal_state,
-                ortschaft = locality)
+                bundesland = federal_state)
+            if self._split == "street":
+                directory = "{}/{}".format(directory, locality)
         else:
-            directory = "results/{datum}/{bundesland}/Bezirk_{bezirk}/gemeinde_{gemeinde}/{ortschaft}".format(
+            directory = "results/{datum}/{bundesland}/Bezirk_{bezirk}".format(
                 datum = self._bev_date,
                 bundesland = federal_state,
-                bezirk = BEZIRK[self._current_gkz[:3]],
-                gemeinde = district,
-                ortschaft = locality)
-        if not os.path.isdir(directory):
-            os.makedirs(directory)
+                bezirk = BEZIRK[self._current_gkz[:3]])
+            if self._split == "street":
+                directory = "{}/gemeinde_{}/{}".format(directory, district, locality)
         if args.here_be_dragons:
             prefix = "DRAGONS_"
         elif args.only_notes:
             prefix = "NOTES_"
         else:
             prefix = ""
-        self.output_filename = "%s%s_%s_%s_(%s).osm" % (
-            prefix,
-            "".join(c for c in self._current_street if c.isalnum()),
-            self._current_postcode, 
-            locality,
-            district
-        )
-        tree.write(os.path.join(directory, self.output_filename), encoding="utf-8", xml_declaration=True)
-
-    def _format(self):
-        self.root.text = "\n"
-        for node in self.root.getchildren():
-            node.tail = "\n"
+        if self._split == "street":
+            self.output_filename = "%s%s_%s_%s_(%s)" % (
+                prefix,
+                sanitize_name(self._current_street),
+                self._current_postcode,
+                locality,
+                district
+            )
+        elif self._split == "gemeinde":
+            self.output_filename = "%s%s_%s" % (prefix, district, self._current_gkz)
+        else:
+            self.output_filename = "%saustria" % prefix
+        self.output_filename += self._get_extension()
+        return directory, self.output_filename
+
+    def _get_extension(self):
+        return ".osc" if self._change_file else ".osm"
 
     def _get_id(self, address):
         return "-%s%s" % (address["adrcd"], address["subcd"])
 
+@functools.lru_cache(maxsize=None)
+def sanitize_name(name):
+    """strips everything but letters and digits from a name used in file paths"""
+    return "".join(c for c in name if c.isalnum())
+
+def _pbf_varint(value):
+    """encodes an unsigned integer as protocol buffer varint"""
+    result = bytearray()
+    while value > 0x7f:
+        result.append((value & 0x7f) | 0x80)
+        value >>= 7
+    result.append(value)
+    return bytes(result)
+
+def _pbf_zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+def _pbf_key(field, wire_type):
+    return _pbf_varint((field << 3) | wire_type)
+
+def _pbf_uint(field, value):
+    return _pbf_key(field, 0) + _pbf_varint(value)
+
+def _pbf_bytes(field, value):
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    return _pbf_key(field, 2) + _pbf_varint(len(value)) + value
+
+def _pbf_packed(field, values, signed=False):
+    if signed:
+        values = (_pbf_zigzag(v) for v in values)
+    return _pbf_bytes(field, b"".join(_pbf_varint(v) for v in values))
+
+def _pbf_delta(values):
+    previous = 0
+    for v in values:
+        yield v - previous
+        previous = v
+
+class PbfWriter(OsmWriter):
+    """Writes the addresses as OSM PBF with zlib compressed blocks of
+    `chunk_size` DenseNodes. Node ids and tags are the same as in the osm
+    output. Only the gemeinde and national splits are supported."""
+
+    def __init__(self, split="national", chunk_size=8000, bev_date=None):
+        OsmWriter.__init__(self, split, chunk_size=chunk_size, bev_date=bev_date)
+
+    def _add_node(self, node_id, lat, lon, tags):
+        # coordinates are stored with the default granularity of 100 nanodegrees
+        self._nodes.append((int(node_id), int(round(lat * 10000000)), int(round(lon * 10000000)), tags))
+
+    def _write_blob(self, blob_type, data):
+        blob = _pbf_uint(2, len(data)) + _pbf_bytes(3, zlib.compress(data))
+        header = _pbf_bytes(1, blob_type) + _pbf_uint(3, len(blob))
+        self._handle.write(struct.pack(">I", len(header)))
+        self._handle.write(header)
+        self._handle.write(blob)
+
+    def _write_nodes(self):
+        if self._handle is None:
+            self._handle = self._open_output('wb')
+            header_block = (_pbf_bytes(4, "OsmSchema-V0.6") + _pbf_bytes(4, "DenseNodes") +
+                            _pbf_bytes(16, "convert-addresses.py"))
+            self._write_blob("OSMHeader", header_block)
+        if len(self._nodes) == 0:
+            return
+        strings = {"": 0}
+        keys_vals = []
+        for node in self._nodes:
+            for k, v in node[3]:
+                keys_vals.append(strings.setdefault(k, len(strings)))
+                keys_vals.append(strings.setdefault(v, len(strings)))
+            keys_vals.append(0)
+        dense = (_pbf_packed(1, _pbf_delta(node[0] for node in self._nodes), signed=True) +
+                 _pbf_packed(8, _pbf_delta(node[1] for node in self._nodes), signed=True) +
+                 _pbf_packed(9, _pbf_delta(node[2] for node in self._nodes), signed=True) +
+                 _pbf_packed(10, keys_vals))
+        string_table = b"".join(_pbf_bytes(1, s) for s in sorted(strings, key=strings.get))
+        primitive_block = _pbf_bytes(1, string_table) + _pbf_bytes(2, _pbf_bytes(2, dense))
+        self._write_blob("OSMData", primitive_block)
+        self._nodes = []
+
+    def _close_group(self):
+        self._write_nodes()
+        self._handle.close()
+        self._handle = None
+        self._get_bounds()
+
+    def _get_extension(self):
+        return ".osm.pbf"
+
+SPACE_FILLING_CURVES = ("hilbert", "morton")
+
+def morton_key(x, y, order=16):
+    """interleaves the bits of the grid cell coordinates x and y (Z-order),
+    order may be at most 16. Works on integers as well as on numpy integer
+    arrays"""
+    def spread(v):
+        v = v & ((1 << order) - 1)
+        v = (v | (v << 8)) & 0x00ff00ff
+        v = (v | (v << 4)) & 0x0f0f0f0f
+        v = (v | (v << 2)) & 0x33333333
+        return (v | (v << 1)) & 0x55555555
+    return spread(x) | (spread(y) << 1)
+
+def hilbert_key(x, y, order=16):
+    """returns the distance of grid cell (x, y) along a Hilbert curve filling
+    a 2^order x 2^order grid. The quadrant rotation is done with arithmetic
+    instead of branches, so it works on integers as well as on numpy integer
+    arrays"""
+    n = 1 << order
+    d = 0
+    for bit in range(order - 1, -1, -1):
+        rx = (x >> bit) & 1
+        ry = (y >> bit) & 1
+        d = d + (1 << (2 * bit)) * ((3 * rx) ^ ry)
+        # rotate the quadrant: flip if ry == 0 and rx == 1, then swap if ry == 0
+        flip = (n - 1) * (rx & (1 - ry))
+        x = x ^ flip
+        y = y ^ flip
+        swap = (x ^ y) * (1 - ry)
+        x = x ^ swap
+        y = y ^ swap
+    return d
+
+def spatial_sort_order(xs, ys, curve, order=16):
+    """returns the indices of the points (xs, ys) sorted by their position on
+    the given space-filling curve. Points with the same key keep their order"""
+    key_function = hilbert_key if curve == "hilbert" else morton_key
+    cells = (1 << order) - 1
+    if numpyModule:
+        xs = numpy.asarray(xs, dtype=numpy.float64)
+        ys = numpy.asarray(ys, dtype=numpy.float64)
+        min_x, min_y = xs.min(), ys.min()
+        scale = cells / max(xs.max() - min_x, ys.max() - min_y, 1e-9)
+        gx = numpy.minimum(((xs - min_x) * scale).astype(numpy.int64), cells)
+        gy = numpy.minimum(((ys - min_y) * scale).astype(numpy.int64), cells)
+        return numpy.argsort(key_function(gx, gy, order), kind="stable").tolist()
+    min_x, min_y = min(xs), min(ys)
+    scale = cells / max(max(xs) - min_x, max(ys) - min_y, 1e-9)
+    keys = [key_function(min(int((x - min_x) * scale), cells), min(int((y - min_y) * scale), cells), order)
+            for x, y in zip(xs, ys)]
+    return sorted(range(len(keys)), key=keys.__getitem__)
+
+class SpatialSortWriter():
+    """Buffers the output rows of another writer and passes them on sorted
+    along a space-filling curve when it is closed. The position of a row is
+    its building position if it has one, its address position otherwise.
+    Rows are kept as tuples in the order of `header_row` and only turned
+    back into dicts when they are passed on"""
+
+    def __init__(self, writer, curve, header_row):
+        self._writer = writer
+        self._curve = curve
+        self._header_row = header_row
+        self._rows = []
+        self._xs = array.array('d')
+        self._ys = array.array('d')
+
+    @property
+    def rows_written(self):
+        return self._writer.rows_written
+
+    def add_address(self, address):
+        # the caller reuses the dict for every building of an address, so the values are copied
+        self._rows.append(tuple(address.get(column) for column in self._header_row))
+        if "haus_x" in address and str(address["haus_x"]).strip() != "":
+            self._xs.append(float(address["haus_x"]))
+            self._ys.append(float(address["haus_y"]))
+        else:
+            self._xs.append(float(address["adress_x"]))
+            self._ys.append(float(address["adress_y"]))
+
+    def close(self):
+        if self._rows:
+            for i in spatial_sort_order(self._xs, self._ys, self._curve):
+                self._writer.add_address(dict((column, value) for column, value in zip(self._header_row, self._rows[i])
+                                              if value is not None))
+        self._rows = []
+        self._xs = array.array('d')
+        self._ys = array.array('d')
+        self._writer.close()
+
+@functools.lru_cache(maxsize=None)
+def shard_of(gkz, shard_count):
+    """returns the 1-based shard a Gemeinde is assigned to. crc32 is used
+    because it is stable across runs and machines, unlike hash()"""
+    return zlib.crc32(gkz.encode("utf-8")) % shard_count + 1
+
+class ShardWriter():
+    """Writes the output rows of a shard as gzip compressed JSON lines. Every
+    row is stored with its sort key and the position of its address in
+    ADRESSE.csv, so merge_shards() can restore the order of a single run"""
+
+    def __init__(self, filename, sort_keys):
+        self._handle = gzip.open(filename, 'wt', encoding='utf-8')
+        self._sort_keys = sort_keys
+        self.rows_written = 0
+
+    def add_address(self, address):
+        key, position = self._sort_keys[address["adrcd"]]
+        self._handle.write(json.dumps([key, position, address], ensure_ascii=False))
+        self._handle.write("\n")
+        self.rows_written += 1
+
+    def close(self):
+        self._handle.close()
+
+def read_shard(filename):
+    with gzip.open(filename, 'rt', encoding='utf-8') as handle:
+        for line in handle:
+            yield json.loads(line)
+
+def create_output_writer(output_header_row, bev_date=None):
+    """returns the writer for the output format given by the arguments"""
+    if args.output_format == "pbf":
+        output_writer = PbfWriter(args.osm_split, bev_date=bev_date)
+    elif args.output_format in ("osm", "osc"):
+        output_writer = OsmWriter(args.osm_split, args.output_format == "osc", threads=args.writer_threads, bev_date=bev_date)
+    elif args.output_format == "arrow":
+        outputFilename = "bev_addressesEPSG{}.arrow".format(args.epsg)
+        output_writer = ArrowWriter(outputFilename, output_header_row, output_path=args.arrow_path)
+    else:
+        outputFilename = "bev_addressesEPSG{}.{}".format(args.epsg, args.output_format)
+        output_writer = CsvWriter(outputFilename, output_header_row)
+    if args.sort in SPACE_FILLING_CURVES:
+        # the output rows are only known after the buildings are joined, so they are sorted by the writer
+        output_writer = SpatialSortWriter(output_writer, args.sort, output_header_row)
+    return output_writer
+
+def merge_shards(manifest_filenames, output_header_row, metrics):
+    """combines the partial outputs of all shards of a -shard run into the
+    output a single run would have written and returns the summed counters"""
+    if not manifest_filenames:
+        if not os.path.isdir("results"):
+            print("\n##### ERROR ##### \nNo shard manifests given and there is no results directory to look for them.")
+            quit()
+        manifest_filenames = sorted(os.path.join("results", f) for f in os.listdir("results")
+                                    if f.startswith("shard_") and f.endswith(".json"))
+    manifests = []
+    for filename in manifest_filenames:
+        with open(filename, 'r') as handle:
+            manifest = json.load(handle)
+        manifest["directory"] = os.path.dirname(filename)
+        manifests.append(manifest)
+    if not manifests:
+        print("\n##### ERROR ##### \nNo shard manifests found.")
+        quit()
+    shard_count = manifests[0]["shard_count"]
+    if any(m["shard_count"] != shard_count for m in manifests):
+        print("\n##### ERROR ##### \nThe shards were split into different numbers of shards: %s" % (
+            ", ".join("%d/%d" % (m["shard_index"], m["shard_count"]) for m in manifests)))
+        quit()
+    if sorted(m["shard_index"] for m in manifests) != list(range(1, shard_count + 1)):
+        print("\n##### ERROR ##### \nThe manifests of all shards 1 to %d are needed, got %s" % (
+            shard_count, ", ".join("%d/%d" % (m["shard_index"], m["shard_count"]) for m in manifests)))
+        quit()
+    if any(m["arguments"] != manifests[0]["arguments"] for m in manifests):
+        print("\n##### ERROR ##### \nThe shards were processed with different arguments.")
+        quit()
+    if any(m["input"] != manifests[0]["input"] for m in manifests):
+        print("\n##### ERROR ##### \nThe shards were processed from different BEV data.")
+        quit()
+    for key, value in manifests[0]["arguments"].items():
+        setattr(args, key, value)
+    # the output format comes from the manifest, so the check done for the command line is repeated
+    if args.output_format == 'arrow' and not arrowModule:
+        print("\n##### ERROR ##### \nThe arrow output format requires the pyarrow module.")
+        quit()
+
+    ambiguous_okz = set()
+    counters = defaultdict(int)
+    for manifest in manifests:
+        ambiguous_okz.update(manifest["okz_with_ambiguous_streetnames"])
+        for key, value in manifest["counters"].items():
+            counters[key] += value
+    counters["gkz_with_ambiguous_streetnames"] = manifests[0]["gkz_with_ambiguous_streetnames"]
+    counters["okz_with_ambiguous_streetnames"] = len(ambiguous_okz)
+    print("GKZ with ambiguous streetnames: ", counters["gkz_with_ambiguous_streetnames"])
+    print("OKZ with ambiguous streetnames: ", counters["okz_with_ambiguous_streetnames"])
+
+    # every shard is sorted by (sort key, position in ADRESSE.csv), which is the order of a single run
+    rows = heapq.merge(*[read_shard(os.path.join(m["directory"], m["partial"])) for m in manifests],
+                       key=operator.itemgetter(0, 1))
+    total_rows = sum(m["rows"] for m in manifests)
+    output_writer = create_output_writer(output_header_row, manifests[0]["bev_date"])
+    with metrics.stage("merge") as stage, ProgressBar("merging %d shards ..." % shard_count, total_rows, 1000) as pb:
+        for i, (key, position, row) in enumerate(rows):
+            pb.update(i)
+            output_writer.add_address(row)
+        output_writer.close()
+        stage.rows_in = total_rows
+        stage.rows_out = output_writer.rows_written
+    return dict(counters)
+
 class ProgressBar():
-    def __init__(self, message=None):
+    """Prints a progress bar to stdout. The bar is redrawn at most every
+    `interval` seconds, and the clock is only consulted every `stride` calls
+    to update(), so calling it once per row is cheap. If `total` is given,
+    update() expects a row count instead of a percentage."""
+
+    def __init__(self, message=None, total=None, stride=1, interval=0.5):
         self.percentage = 0
+        self.total = total
+        self.stride = stride
+        self.interval = interval
+        self._next_check = 0
+        self._next_draw = 0
         if message:
             print(message)
-    
-    def update(self, new_percentage):
+
+    def update(self, value):
+        if value < self._next_check:
+            return
+        self._next_check = value + self.stride
+        now = time.monotonic()
+        if now < self._next_draw:
+            return
+        self._next_draw = now + self.interval
+        if self.total:
+            value = float(value) / self.total * 100
+        self._draw(value)
+
+    def _draw(self, new_percentage):
         new_percentage = round(new_percentage, 2)
         if new_percentage != self.percentage:
             sys.stdout.write("\r{} %   ".format(str(new_percentage).ljust(6)))
@@ -403,23 +1049,466 @@ class ProgressBar():
         return self
 
     def __exit__(self, type, value, traceback):
-        self.update(100)
+        self._draw(100)
         sys.stdout.write("\n")
 
-def download_data():
-    """This function downloads the address data from BEV and displays its terms
-    of usage"""
+class StageMetrics():
+    """Row counts, rejection reasons and resource usage of a single stage"""
+
+    def __init__(self, name):
+        self.name = name
+        self.rows_in = 0
+        self.rows_out = 0
+        self.rejections = defaultdict(int)
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.process_peak_rss_kb = None
+        self.peak_rss_growth_kb = None
+        # resource usage of a worker process that did the work of this stage
+        self.worker_cpu_time = None
+        self.worker_peak_rss_kb = None
+
+    def reject(self, reason):
+        self.rejections[reason] += 1
+
+    def as_dict(self):
+        return {
+            "stage": self.name,
+            "wall_time_s": round(self.wall_time, 6),
+            "cpu_time_s": round(self.cpu_time, 6),
+            "process_peak_rss_kb": self.process_peak_rss_kb,
+            "peak_rss_growth_kb": self.peak_rss_growth_kb,
+            "worker_cpu_time_s": round(self.worker_cpu_time, 6) if self.worker_cpu_time is not None else None,
+            "worker_peak_rss_kb": self.worker_peak_rss_kb,
+            "rows_in": self.rows_in,
+            "rows_out": self.rows_out,
+            "rejections": dict(self.rejections),
+            "rows_per_s": round(self.rows_in / self.wall_time, 1) if self.wall_time > 0 else None
+        }
+
+class RunMetrics():
+    """Collects the StageMetrics of a run and writes them as JSON report.
+    If a profile directory is given, every stage is run under cProfile and
+    its statistics are dumped to <profile_directory>/<stage>.prof"""
+
+    def __init__(self, profile_directory=None):
+        self.stages = []
+        self.counters = {}
+        self.profile_directory = profile_directory
+        self._started = time.time()
+        if profile_directory and not os.path.isdir(profile_directory):
+            os.makedirs(profile_directory)
+
+    @contextmanager
+    def stage(self, name):
+        stage = StageMetrics(name)
+        profiler = None
+        if self.profile_directory:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        rss_start = peak_rss_kb()
+        try:
+            yield stage
+        finally:
+            stage.wall_time = time.perf_counter() - wall_start
+            stage.cpu_time = time.process_time() - cpu_start
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(os.path.join(self.profile_directory, "{}.prof".format(name)))
+            # the peak RSS is a high-water mark of the whole process, so a stage can
+            # only be attributed the amount by which it raised that mark
+            stage.process_peak_rss_kb = peak_rss_kb()
+            if rss_start is not None:
+                stage.peak_rss_growth_kb = stage.process_peak_rss_kb - rss_start
+            self.stages.append(stage)
+
+    def as_dict(self):
+        return {
+            "started": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(self._started)),
+            "wall_time_s": round(sum(stage.wall_time for stage in self.stages), 6),
+            "cpu_time_s": round(sum(stage.cpu_time + (stage.worker_cpu_time or 0) for stage in self.stages), 6),
+            "peak_rss_kb": peak_rss_kb(),
+            "arguments": vars(args),
+            "stages": [stage.as_dict() for stage in self.stages],
+            "counters": self.counters
+        }
+
+    def write(self, filename):
+        with open(filename, 'w') as handle:
+            json.dump(self.as_dict(), handle, indent=2)
+
+def peak_rss_kb():
+    """returns the peak resident set size of this process in kilobytes or
+    None if it cannot be determined on this platform"""
+    if not resourceModule:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # macOS reports bytes instead of kilobytes
+        peak //= 1024
+    return peak
+
+def download_chunks(pb=None):
+    """This generator downloads the address data from BEV, saves it as
+    ZIP_FILENAME and yields the chunks as they arrive"""
 
     if not requestsModule:
         print("source data missing and download is deactivated")
         quit()
     addressdataUrl = "http://www.bev.gv.at/pls/portal/docs/PAGE/BEV_PORTAL_CONTENT_ALLGEMEIN/0200_PRODUKTE/UNENTGELTLICHE_PRODUKTE_DES_BEV/Adresse-Relationale_Tabellen_Stichtagsdaten.zip"
     response = requests.get(addressdataUrl, stream=True)
-    with open(addressdataUrl.split('/')[-1], 'wb') as handle, ProgressBar("downloading address data from BEV") as pb:
+    with open(ZIP_FILENAME, 'wb') as handle:
         for i, data in enumerate(response.iter_content(chunk_size=1000000)):
             handle.write(data)
-            current_percentage = i * 1.3
-            pb.update(current_percentage)
+            if pb is not None:
+                pb.update(i * 1.3)
+            yield data
+
+def download_data():
+    """This function downloads the address data from BEV and displays its terms
+    of usage"""
+
+    with ProgressBar("downloading address data from BEV") as pb:
+        for data in download_chunks(pb):
+            pass
+
+def read_chunks(filename, chunk_size=1000000):
+    with open(filename, 'rb') as handle:
+        data = handle.read(chunk_size)
+        while data:
+            yield data
+            data = handle.read(chunk_size)
+
+def _zip_extra_ids(extra):
+    """returns the header ids of the fields in a zip extra block (0x0001 is zip64)"""
+    ids = []
+    i = 0
+    while i + 4 <= len(extra):
+        header_id, size = struct.unpack("<HH", extra[i:i + 4])
+        ids.append(header_id)
+        i += 4 + size
+    return ids
+
+def _extract_member(buffer, fill, handle, method, flags, crc, compressed_size):
+    """decompresses the member whose data starts at the beginning of `buffer`
+    into `handle` (if not None) and returns (checksum, crc) with the crc taken
+    from the data descriptor if there is one, or (False, None) if the member
+    cannot be handled"""
+    checksum = 0
+    if method == 8:
+        inflater = zlib.decompressobj(-15)
+        while not inflater.eof:
+            if not buffer and not fill(1):
+                return False, None
+            data = inflater.decompress(bytes(buffer))
+            del buffer[:]
+            checksum = zlib.crc32(data, checksum)
+            if handle:
+                handle.write(data)
+        buffer.extend(inflater.unused_data)
+    elif method == 0 and not flags & 0x8:
+        if not fill(compressed_size):
+            return False, None
+        data = bytes(buffer[:compressed_size])
+        del buffer[:compressed_size]
+        checksum = zlib.crc32(data)
+        if handle:
+            handle.write(data)
+    else:
+        return False, None
+    if flags & 0x8:
+        # the sizes and checksum follow the data in a data descriptor
+        if not fill(16):
+            return False, None
+        if buffer[:4] == b"PK\x07\x08":
+            del buffer[:4]
+        crc = struct.unpack("<I", bytes(buffer[:4]))[0]
+        del buffer[:12]
+    return checksum, crc
+
+def stream_extract(chunks, members, available):
+    """Extracts the given members of a zip archive in a single pass over its
+    bytes, e.g. while it is downloaded, and sets the event in `available` as
+    soon as a member is completely written. This relies on the local file
+    headers instead of the central directory at the end of the archive.
+    Returns False if the archive uses features this cannot handle (zip64,
+    encryption, stored entries of unknown size), the caller then has to
+    extract the remaining members with zipfile."""
+    chunks = iter(chunks)
+    buffer = bytearray()
+
+    def fill(size):
+        while len(buffer) < size:
+            data = next(chunks, None)
+            if data is None:
+                return False
+            buffer.extend(data)
+        return True
+
+    while fill(4) and buffer[:4] == b"PK\x03\x04":
+        if not fill(30):
+            return False
+        (flags, method, crc, compressed_size, name_length, extra_length) = operator.itemgetter(2, 3, 6, 7, 9, 10)(
+            struct.unpack("<IHHHHHIIIHH", bytes(buffer[:30])))
+        if not fill(30 + name_length + extra_length):
+            return False
+        name = bytes(buffer[30:30 + name_length]).decode("utf-8" if flags & 0x800 else "cp437")
+        extra = bytes(buffer[30 + name_length:30 + name_length + extra_length])
+        del buffer[:30 + name_length + extra_length]
+        if flags & 0x1 or compressed_size == 0xffffffff or 0x0001 in _zip_extra_ids(extra):
+            return False
+        handle = open(name + ".part", 'wb') if name in members else None
+        checksum = False
+        try:
+            checksum, crc = _extract_member(buffer, fill, handle, method, flags, crc, compressed_size)
+        finally:
+            # close the file on every way out, an open file cannot be
+            # removed on windows
+            if handle:
+                handle.close()
+                if checksum is False:
+                    os.remove(name + ".part")
+        if checksum is False:
+            return False
+        if handle:
+            if checksum != crc:
+                os.remove(name + ".part")
+                raise zipfile.BadZipFile("Bad CRC-32 for file %r" % name)
+            os.replace(name + ".part", name)
+            available[name].set()
+    # consume the rest, so a download is saved completely
+    for data in chunks:
+        pass
+    return True
+
+def check_address(reader_row):
+    """applies the checks to a row of ADRESSE.csv that need neither a
+    reprojection nor the lookup tables and returns (housenumber, None) or
+    (None, reason) if the row has to be ignored"""
+    if args.shard is not None and shard_of(reader_row["GKZ"], args.shard_count) != args.shard_index:
+        return None, "other_shard"
+    # some entries don't have coordinates: ignore these entries
+    if reader_row["RW"] == '' or reader_row["HW"] == '':
+        return None, "missing_coordinates"
+    housenumber = build_housenumber(reader_row["HAUSNRZAHL1"], 
+                reader_row["HAUSNRBUCHSTABE1"],
+                reader_row["HAUSNRVERBINDUNG1"],
+                reader_row["HAUSNRZAHL2"],
+                reader_row["HAUSNRBUCHSTABE2"],
+                reader_row["HAUSNRBEREICH"])
+    # some entries don't have a housenumber: ignore these entries
+    if housenumber == '':
+        return None, "no_housenumber"
+    elif not any(char.isdigit() for char in housenumber) and not args.here_be_dragons:
+        return None, "housenumber_without_digits"
+    return housenumber, None
+
+def parse_building(buildingrow):
+    """reprojects a row of GEBAEUDE.csv and returns (building_info, None) or
+    (None, reason) if the row has to be ignored"""
+    x = buildingrow["RW"]
+    y = buildingrow["HW"]
+    if x == "" or y == "":
+        return None, "missing_coordinates"
+    coords = reproject(buildingrow["EPSG"], [x, y])
+    # if the reprojection returned [0,0], this indicates an error
+    if coords == [0, 0]:
+        return None, "reprojection_failed"
+    subaddress = build_sub_housenumber(
+        buildingrow["HAUSNRZAHL3"],
+        buildingrow["HAUSNRBUCHSTABE3"],
+        buildingrow["HAUSNRVERBINDUNG2"],
+        buildingrow["HAUSNRZAHL4"],
+        buildingrow["HAUSNRBUCHSTABE4"],
+        buildingrow["HAUSNRVERBINDUNG3"]
+    )
+    building_info = coords
+    building_info.append(subaddress)
+    building_info.append(buildingrow["HAUSNRGEBAEUDEBEZ"])
+    building_info.append(buildingrow["SUBCD"])
+    return building_info, None
+
+def parse_buildings(available, building_queue, batch_size, profile_directory=None):
+    """Runs in a separate process: waits for ADRESSE.csv and GEBAEUDE.csv,
+    parses and reprojects the buildings of main addresses that pass
+    check_address() and puts them on the queue in batches of (ADRCD,
+    building_info) in file order, followed by a dict with the row count,
+    rejection reasons, the (ADRCD, reason) of the buildings that could not
+    be parsed and the resource usage of this process. With a
+    `profile_directory` it is profiled on its own and dumps
+    buildings_worker.prof"""
+    # a forked process inherits the profiler of the stage that started it
+    sys.setprofile(None)
+    profiler = None
+    if profile_directory:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    available["ADRESSE.csv"].wait()
+    with open('ADRESSE.csv', 'r', encoding='UTF-8-sig') as handle:
+        address_ids = set(reader_row["ADRCD"] for reader_row in csv.DictReader(handle, delimiter=';', quotechar='"')
+            if check_address(reader_row)[1] is None)
+    available["GEBAEUDE.csv"].wait()
+    rejections = defaultdict(int)
+    failed = []
+    rows = 0
+    batch = []
+    with open('GEBAEUDE.csv', 'r', encoding='UTF-8-sig') as handle:
+        for buildingrow in csv.DictReader(handle, delimiter=';', quotechar='"'):
+            rows += 1
+            if buildingrow["HAUPTADRESSE"] != "1":
+                rejections["not_main_address"] += 1
+                continue
+            # only reproject buildings whose address can end up in the output
+            if buildingrow["ADRCD"] not in address_ids:
+                rejections["unknown_address"] += 1
+                continue
+            building_info, reason = parse_building(buildingrow)
+            if reason:
+                # the address may still be rejected, which takes precedence as in a sequential run
+                failed.append((buildingrow["ADRCD"], reason))
+                continue
+            batch.append((buildingrow["ADRCD"], building_info))
+            if len(batch) >= batch_size:
+                building_queue.put(batch)
+                batch = []
+    if batch:
+        building_queue.put(batch)
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(os.path.join(profile_directory, "buildings_worker.prof"))
+    building_queue.put({"rows": rows, "rejections": dict(rejections), "failed": failed,
+        "cpu_time": time.process_time(), "peak_rss_kb": peak_rss_kb()})
+
+class Pipeline():
+    """Overlaps the stages that otherwise run one after another: the csv files
+    are extracted while the archive is downloaded (or read), the lookup tables
+    are loaded in a thread as soon as their files exist, and GEBAEUDE.csv is
+    parsed and reprojected in a separate process, which reads the ADRCDs of
+    the valid addresses of ADRESSE.csv first. The process hands batches
+    of `batch_size` buildings to this process through a queue of at most
+    `max_batches` batches, where a thread collects them per address. With a
+    `profile_directory` the process dumps its own profile there."""
+
+    def __init__(self, batch_size=10000, max_batches=64, profile_directory=None):
+        self._available = dict((name, threading.Event()) for name in CSV_FILES)
+        self._worker_available = dict((name, multiprocessing.Event()) for name in ("ADRESSE.csv", "GEBAEUDE.csv"))
+        self._building_queue = multiprocessing.Queue(max_batches)
+        self._batch_size = batch_size
+        self._profile_directory = profile_directory
+        self._errors = []
+        self._lookup_stage = StageMetrics("lookup_tables")
+        self._lookup_tables = None
+        self._buildings = defaultdict(list)
+        self._building_summary = None
+
+    def start(self):
+        # the process is started before any thread, so it is not forked from a multithreaded process
+        self._process = multiprocessing.Process(target=parse_buildings,
+            args=(self._worker_available, self._building_queue, self._batch_size, self._profile_directory), daemon=True)
+        self._process.start()
+        self._extract_thread = self._start_thread(self._extract)
+        self._lookup_thread = self._start_thread(self._load_lookup_tables)
+        self._collect_thread = self._start_thread(self._collect_buildings)
+
+    def _start_thread(self, target):
+        def run():
+            try:
+                target()
+            except BaseException as e:
+                self._errors.append(e)
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def _extract(self):
+        missing = [name for name in CSV_FILES if not os.path.isfile(name)]
+        for name in CSV_FILES:
+            if name not in missing:
+                self._set_available(name)
+        if not missing:
+            return
+        if os.path.isfile(ZIP_FILENAME):
+            print("extracting %s" % ", ".join(missing))
+            chunks = read_chunks(ZIP_FILENAME)
+        else:
+            print("downloading address data from BEV and extracting %s" % ", ".join(missing))
+            chunks = download_chunks()
+        available = dict((name, self._available[name]) for name in missing)
+        if not stream_extract(chunks, missing, available):
+            print("the archive cannot be extracted while it is read, extracting it afterwards ...")
+            for data in chunks:
+                pass
+            with zipfile.ZipFile(ZIP_FILENAME, 'r') as myzip:
+                for name in missing:
+                    if not self._available[name].is_set():
+                        if os.path.isfile(name + ".part"):
+                            os.remove(name + ".part")
+                        myzip.extract(name)
+                        self._set_available(name)
+        for name in missing:
+            if not self._available[name].is_set():
+                raise IOError("%s was not found in %s" % (name, ZIP_FILENAME))
+            self._set_available(name)
+
+    def _set_available(self, name):
+        self._available[name].set()
+        if name in self._worker_available:
+            self._worker_available[name].set()
+
+    def _load_lookup_tables(self):
+        for name in ("ORTSCHAFT.csv", "GEMEINDE.csv", "STRASSE.csv"):
+            self._available[name].wait()
+        self._lookup_tables = load_lookup_tables(self._lookup_stage)
+
+    def _collect_buildings(self):
+        while True:
+            try:
+                batch = self._building_queue.get(timeout=1)
+            except queue.Empty:
+                if not self._process.is_alive():
+                    raise RuntimeError("parsing GEBAEUDE.csv failed with exit code %s" % self._process.exitcode)
+                continue
+            if isinstance(batch, dict):
+                self._building_summary = batch
+                return
+            for address_id, building_info in batch:
+                self._buildings[address_id].append(building_info)
+
+    def _wait(self, done):
+        while not done():
+            if self._errors:
+                raise self._errors[0]
+            time.sleep(0.05)
+        if self._errors:
+            raise self._errors[0]
+
+    def wait_for(self, name):
+        """blocks until the given csv file is extracted"""
+        self._wait(self._available[name].is_set)
+
+    def lookup_tables(self, stage):
+        self._wait(lambda: not self._lookup_thread.is_alive())
+        stage.rows_in = self._lookup_stage.rows_in
+        stage.rows_out = self._lookup_stage.rows_out
+        return self._lookup_tables
+
+    def buildings(self, stage):
+        """returns the parsed buildings of all main addresses grouped by ADRCD"""
+        # the writers may need the complete archive, so the extraction has to be finished as well
+        self._wait(lambda: not self._collect_thread.is_alive() and not self._extract_thread.is_alive())
+        self._process.join()
+        stage.rows_in = self._building_summary["rows"]
+        stage.worker_cpu_time = self._building_summary["cpu_time"]
+        stage.worker_peak_rss_kb = self._building_summary["peak_rss_kb"]
+        for reason, count in self._building_summary["rejections"].items():
+            stage.rejections[reason] += count
+        return self._buildings
+
+    def failed_buildings(self):
+        """returns (ADRCD, reason) of the buildings that could not be parsed"""
+        return self._building_summary["failed"]
 
 
 def reproject(sourceCRS, point):
@@ -510,41 +1599,20 @@ def build_sub_housenumber(hausnrzahl3, hausnrbuchstabe3, hausnrverbindung2, haus
 
 def preparations():
     """check for necessary files and issue downloads when necessary"""
-    csv_files = ["STRASSE.csv", "GEMEINDE.csv", "ADRESSE.csv", "GEBAEUDE.csv", "ORTSCHAFT.csv"]
-    if not all(os.path.isfile(csv) for csv in csv_files):
+    if not all(os.path.isfile(csv) for csv in CSV_FILES):
         # ckeck if the packed version exists
-        if not os.path.isfile('Adresse_Relationale_Tabellen-Stichtagsdaten.zip'):
+        if not os.path.isfile(ZIP_FILENAME):
             # if not, download it
             download_data()
-        with zipfile.ZipFile('Adresse_Relationale_Tabellen-Stichtagsdaten.zip', 'r') as myzip:
-            for csv in csv_files:
+        with zipfile.ZipFile(ZIP_FILENAME, 'r') as myzip:
+            for csv in CSV_FILES:
                 print("extracting %s" % csv)
                 myzip.extract(csv)
     return True
 
-''' strips whitespace/dash, ß->ss, ignore case '''
-def normalize_streetname(street):
-    s = street.replace("ß", "ss").replace(" ", "").replace("-", "").lower()
-    if s.endswith("str.") or s.endswith("g."):
-        s = s[:-1] + "asse"
-    return s
-
-if __name__ == '__main__':
-    print('#' * 40)
-    print(info)
-    print('#' * 40 + '\n')
-    
-    if not preparations() == True:
-        print("There was an error")
-        quit()
-
-    output_header_row = ['gemeinde', 'ortschaft', 'plz', 'strasse', 'strassenzusatz', 'hausnrtext', 'hausnummer', 'hausname', 'haus_x', 'haus_y', 'gkz', 'adress_x', 'adress_y', 'subadresse', 'haus_bez', 'adrcd', 'subcd', 'okz', 'strassenname_mehrdeutig']
-    if args.sort != None:
-        for s in args.sort.split(","):
-            if s not in output_header_row:
-                print("\n##### ERROR ##### \nSort parameter is not allowed. Use one (or mulitple separated by ',') of %s" % output_header_row)
-                quit()
-
+def load_lookup_tables(stage):
+    """buffers ORTSCHAFT.csv, GEMEINDE.csv and STRASSE.csv and finds the street
+    names that are ambiguous within a Gemeinde"""
     print("buffering localities ...")
     try:
         localityReader = csv.DictReader(open('ORTSCHAFT.csv', 'r', encoding='UTF-8-sig'), delimiter=';', quotechar='"')
@@ -554,6 +1622,7 @@ if __name__ == '__main__':
         quit()
     localities = {}
     for localityrow in localityReader:
+        stage.rows_in += 1
         localities[localityrow['OKZ']] = localityrow['ORTSNAME']
 
     print("buffering districts ...")
@@ -564,6 +1633,7 @@ if __name__ == '__main__':
         quit()
     districts = {}
     for districtrow in districtReader:
+        stage.rows_in += 1
         districts[districtrow['GKZ']] = districtrow['GEMEINDENAME']
     print("GKZ overall: ", len(districts))
 
@@ -577,8 +1647,8 @@ if __name__ == '__main__':
     gkz_streets = defaultdict(list)
     gkz_has_ambiguous_streetnames = defaultdict(bool)
     ambiguous_streetnames = defaultdict(list)
-    okz_has_ambiguous_streetnames = defaultdict(bool)
     for streetrow in streetReader:
+        stage.rows_in += 1
         streetname = streetrow['STRASSENNAME'].strip()
         streets[streetrow['SKZ']] = [streetname, streetrow['STRASSENNAMENZUSATZ']]
         gkz = streetrow['GKZ']
@@ -588,46 +1658,84 @@ if __name__ == '__main__':
         else:
             gkz_streets[gkz].append(normalize_streetname(streetname))
     print("GKZ with ambiguous streetnames: ", len(gkz_has_ambiguous_streetnames))
+    stage.rows_out = len(localities) + len(districts) + len(streets)
+    return localities, districts, streets, gkz_has_ambiguous_streetnames, ambiguous_streetnames
+
+''' strips whitespace/dash, ß->ss, ignore case '''
+def normalize_streetname(street):
+    s = street.replace("ß", "ss").replace(" ", "").replace("-", "").lower()
+    if s.endswith("str.") or s.endswith("g."):
+        s = s[:-1] + "asse"
+    return s
+
+if __name__ == '__main__':
+    print('#' * 40)
+    print(info)
+    print('#' * 40 + '\n')
+
+    metrics = RunMetrics(args.profile)
+    output_header_row = ['gemeinde', 'ortschaft', 'plz', 'strasse', 'strassenzusatz', 'hausnrtext', 'hausnummer', 'hausname', 'haus_x', 'haus_y', 'gkz', 'adress_x', 'adress_y', 'subadresse', 'haus_bez', 'adrcd', 'subcd', 'okz', 'strassenname_mehrdeutig']
+    if args.command == "merge":
+        counters = merge_shards(args.manifests, output_header_row, metrics)
+        print("\nfinished")
+        print( time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()) )
+        if args.metrics:
+            metrics.counters = counters
+            metrics.write(args.metrics)
+            print("metrics written to {}".format(args.metrics))
+        quit()
+
+    with metrics.stage("preparations"):
+        if args.pipeline:
+            pipeline = Pipeline(profile_directory=args.profile)
+            pipeline.start()
+        elif not preparations() == True:
+            print("There was an error")
+            quit()
+
+    if args.sort != None and args.sort not in SPACE_FILLING_CURVES:
+        for s in args.sort.split(","):
+            if s not in output_header_row:
+                print("\n##### ERROR ##### \nSort parameter is not allowed. Use one (or mulitple separated by ',') of %s or one of %s" % (output_header_row, SPACE_FILLING_CURVES))
+                quit()
+
+    with metrics.stage("lookup_tables") as stage:
+        if args.pipeline:
+            localities, districts, streets, gkz_has_ambiguous_streetnames, ambiguous_streetnames = pipeline.lookup_tables(stage)
+        else:
+            localities, districts, streets, gkz_has_ambiguous_streetnames, ambiguous_streetnames = load_lookup_tables(stage)
+    okz_has_ambiguous_streetnames = defaultdict(bool)
 
+    if args.pipeline:
+        pipeline.wait_for("ADRESSE.csv")
     try:
         addressReader = csv.DictReader(open('ADRESSE.csv', 'r', encoding='UTF-8-sig'), delimiter=';', quotechar='"')
     except IOError:
         print("\n##### ERROR ##### \nThe file 'ADRESSE.csv' was not found. Please download and unpack the BEV Address data from http://www.bev.gv.at/portal/page?_pageid=713,1604469&_dad=portal&_schema=PORTAL")
         quit()
-    outputFilename = "bev_addressesEPSG{}.{}".format(args.epsg, args.output_format)
 
     # get the total file size for status output
     total_addresses = sum(1 for row in open('ADRESSE.csv', 'r'))
-    with ProgressBar("processing addresses ...") as pb:
+    with metrics.stage("addresses") as stage, ProgressBar("processing addresses ...", total_addresses, 1000) as pb:
         addresses = {}
         buildings = {}
-        for i, reader_row in enumerate(addressReader):
-            current_percentage = float(i) / total_addresses * 100
-            pb.update(current_percentage)
-
-            x = reader_row["RW"]
-            y = reader_row["HW"]
-            # some entries don't have coordinates: ignore these entries
-            if x == '' or y == '':
+        address_positions = {}
+        for reader_row in addressReader:
+            stage.rows_in += 1
+            pb.update(stage.rows_in)
+            housenumber, reason = check_address(reader_row)
+            if reason:
+                stage.reject(reason)
                 continue
+
             usedprojection = reader_row["EPSG"]
-            coords = reproject(usedprojection, [x, y])
+            coords = reproject(usedprojection, [reader_row["RW"], reader_row["HW"]])
             # if the reprojection returned [0,0], this indicates an error: ignore these entries
-            if coords[0] == '0' or coords[1] == '0':
+            if coords == [0, 0]:
+                stage.reject("reprojection_failed")
                 continue
             
             address_id = reader_row["ADRCD"]
-            housenumber = build_housenumber(reader_row["HAUSNRZAHL1"], 
-                        reader_row["HAUSNRBUCHSTABE1"],
-                        reader_row["HAUSNRVERBINDUNG1"],
-                        reader_row["HAUSNRZAHL2"],
-                        reader_row["HAUSNRBUCHSTABE2"],
-                        reader_row["HAUSNRBEREICH"])
-            # some entries don't have a housenumber: ignore these entries
-            if housenumber == '':
-                continue
-            elif not any(char.isdigit() for char in housenumber) and not args.here_be_dragons:
-                continue
             try:
                 gkz = reader_row["GKZ"]
                 okz = reader_row["OKZ"]
@@ -655,56 +1763,73 @@ if __name__ == '__main__':
                 }
                 addresses[address_id] = address
                 buildings[address_id] = []
+                if args.shard is not None:
+                    address_positions[address_id] = stage.rows_in - 1
             except KeyError:
                 # ignore incomplete input files
-                pass
+                stage.reject("incomplete_input")
+        stage.rows_out = len(addresses)
     print("OKZ with ambiguous streetnames: ", len([okz for okz in okz_has_ambiguous_streetnames if okz_has_ambiguous_streetnames[okz] == True]))
 
-    try:
-        buildingReader = csv.DictReader(open('GEBAEUDE.csv', 'r', encoding='UTF-8-sig'), delimiter=';', quotechar='"')
-    except IOError:
-        print("\n##### ERROR ##### \nThe file 'GEBAEUDE.csv' was not found. Please download and unpack the BEV Address data from http://www.bev.gv.at/portal/page?_pageid=713,1604469&_dad=portal&_schema=PORTAL")
-        quit()
-    # get the total file size for status output
-    total_buildings = sum(1 for row in open('GEBAEUDE.csv', 'r'))
-    with ProgressBar("processing buildings ...") as pb:
-        for i, buildingrow in enumerate(buildingReader):
-            current_percentage = float(i) / total_buildings * 100
-            pb.update(current_percentage)
-            if buildingrow["HAUPTADRESSE"] != "1":
-                continue
-            address_id = buildingrow["ADRCD"]
-            if address_id in addresses:
-                x = buildingrow["RW"]
-                y = buildingrow["HW"]
-                if x == "" or y == "":
-                    continue
-                coords = reproject(buildingrow["EPSG"], [x, y])
-                if coords[0] == '0' or coords[1] == '0':
+    if args.pipeline:
+        with metrics.stage("buildings") as stage:
+            print("joining buildings ...")
+            for address_id, address_buildings in pipeline.buildings(stage).items():
+                if address_id in addresses:
+                    buildings[address_id].extend(address_buildings)
+                    stage.rows_out += len(address_buildings)
+                else:
+                    stage.rejections["unknown_address"] += len(address_buildings)
+            for address_id, reason in pipeline.failed_buildings():
+                stage.reject(reason if address_id in addresses else "unknown_address")
+    else:
+        try:
+            buildingReader = csv.DictReader(open('GEBAEUDE.csv', 'r', encoding='UTF-8-sig'), delimiter=';', quotechar='"')
+        except IOError:
+            print("\n##### ERROR ##### \nThe file 'GEBAEUDE.csv' was not found. Please download and unpack the BEV Address data from http://www.bev.gv.at/portal/page?_pageid=713,1604469&_dad=portal&_schema=PORTAL")
+            quit()
+        # get the total file size for status output
+        total_buildings = sum(1 for row in open('GEBAEUDE.csv', 'r'))
+        with metrics.stage("buildings") as stage, ProgressBar("processing buildings ...", total_buildings, 1000) as pb:
+            for buildingrow in buildingReader:
+                stage.rows_in += 1
+                pb.update(stage.rows_in)
+                if buildingrow["HAUPTADRESSE"] != "1":
+                    stage.reject("not_main_address")
                     continue
-                subaddress = build_sub_housenumber(
-                    buildingrow["HAUSNRZAHL3"],
-                    buildingrow["HAUSNRBUCHSTABE3"],
-                    buildingrow["HAUSNRVERBINDUNG2"],
-                    buildingrow["HAUSNRZAHL4"],
-                    buildingrow["HAUSNRBUCHSTABE4"],
-                    buildingrow["HAUSNRVERBINDUNG3"]
-                )
-                building_info = coords
-                building_info.append(subaddress)
-                building_info.append(buildingrow["HAUSNRGEBAEUDEBEZ"])
-                building_info.append(buildingrow["SUBCD"])
-                buildings[address_id].append(building_info)
-
-    if args.sort != None:
+                address_id = buildingrow["ADRCD"]
+                if address_id in addresses:
+                    building_info, reason = parse_building(buildingrow)
+                    if reason:
+                        stage.reject(reason)
+                        continue
+                    buildings[address_id].append(building_info)
+                    stage.rows_out += 1
+                else:
+                    stage.reject("unknown_address")
+
+    if args.sort != None and args.sort not in SPACE_FILLING_CURVES:
         print("\nsorting output ...")
-        output = sorted(addresses.values(), key= operator.itemgetter(*args.sort.split(",")))
+        with metrics.stage("sorting") as stage:
+            output = sorted(addresses.values(), key= operator.itemgetter(*args.sort.split(",")))
+            stage.rows_in = stage.rows_out = len(output)
     else:
         output = addresses.values()
-    if args.output_format == "osm":
-        output_writer = OsmWriter()
+    if args.shard is not None:
+        # curve keys need the extent of all shards, so curve sorting is left to the merge
+        if args.sort != None and args.sort not in SPACE_FILLING_CURVES:
+            sort_fields = args.sort.split(",")
+        else:
+            sort_fields = []
+        shard_keys = {}
+        for address_id, address in addresses.items():
+            shard_keys[address_id] = ([address[f] for f in sort_fields], address_positions[address_id])
+        shard_name = "shard_{}_of_{}".format(args.shard_index, args.shard_count)
+        if not os.path.isdir("results"):
+            os.makedirs("results")
+        output_writer = ShardWriter(os.path.join("results", shard_name + ".jsonl.gz"), shard_keys)
     else:
-        output_writer = CsvWriter(outputFilename, output_header_row)
+        output_writer = create_output_writer(output_header_row)
     num_addresses_without_buildings = 0
     num_addresses_with_one_building = 0
     num_addresses_with_more_buildings = 0
@@ -715,10 +1840,10 @@ if __name__ == '__main__':
     num_addresses_with_mixed_subaddresses = 0
     num_addresses_with_only_subaddresses = 0
     num_addresses_with_buildings_without_subaddresses = 0
-    with ProgressBar("writing output ...") as pb:
+    with metrics.stage("writing") as stage, ProgressBar("writing output ...", len(output), 1000) as pb:
+        stage.rows_in = len(output)
         for i, row in enumerate(output):
-            current_percentage = float(i) / len(output) * 100
-            pb.update(current_percentage)
+            pb.update(i)
             address_buildings = buildings[row["adrcd"]]
             row["subcd"] = "000"
             if args.debug:
@@ -734,12 +1859,12 @@ if __name__ == '__main__':
                         row["haus_y"] = row["adress_y"]
                     if args.only_notes == False or row["hausname"] != "":
                         output_writer.add_address(row)
+                    else:
+                        stage.reject("without_notes")
                     continue
                 elif len(address_buildings) == 1:
                     num_addresses_with_one_building += 1
                     single_building = True
-                    if building_info[3] == "Wohnhaus":
-                        building_info[3] = ""
                 else:
                     num_addresses_with_more_buildings += 1
                     single_building = False
@@ -766,6 +1891,8 @@ if __name__ == '__main__':
                         row["haus_y"] = row["adress_y"]
                         if args.only_notes == False or row["hausname"] != "":
                             output_writer.add_address(row)
+                        else:
+                            stage.reject("without_notes")
                         continue
 
             for building_info in address_buildings:
@@ -794,11 +1921,50 @@ if __name__ == '__main__':
                         num_building_with_subadress += 1
                 if args.only_notes == False or row["haus_bez"] != "" or row["hausname"] != "":
                     output_writer.add_address(row)
+                else:
+                    stage.reject("without_notes")
 
-    output_writer.close()
+        output_writer.close()
+        stage.rows_out = output_writer.rows_written
     print("\nfinished")
     print( time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()) )
 
+    counters = {
+        "addresses_without_buildings": num_addresses_without_buildings,
+        "addresses_with_one_building": num_addresses_with_one_building,
+        "addresses_with_more_buildings": num_addresses_with_more_buildings,
+        "single_buildings_with_subaddress": num_single_building_with_subadress,
+        "single_buildings_without_subaddress": num_single_building_without_subadress,
+        "buildings_with_subaddress": num_building_with_subadress,
+        "buildings_without_subaddress": num_building_without_subadress,
+        "addresses_with_only_subaddresses": num_addresses_with_only_subaddresses,
+        "addresses_with_buildings_without_subaddresses": num_addresses_with_buildings_without_subaddresses,
+        "addresses_with_mixed_subaddresses": num_addresses_with_mixed_subaddresses,
+        "okz_with_ambiguous_streetnames": len([okz for okz in okz_has_ambiguous_streetnames if okz_has_ambiguous_streetnames[okz] == True]),
+        "gkz_with_ambiguous_streetnames": len(gkz_has_ambiguous_streetnames)
+    }
+    if args.shard is not None:
+        manifest = {
+            "shard_index": args.shard_index,
+            "shard_count": args.shard_count,
+            "partial": shard_name + ".jsonl.gz",
+            "rows": output_writer.rows_written,
+            "bev_date": get_bev_date() if args.output_format in ("osm", "osc", "pbf") else None,
+            "input": get_input_fingerprint(),
+            "arguments": dict((key, getattr(args, key)) for key in SHARD_ARGUMENTS),
+            "gkz": sorted(gkz for gkz in districts if shard_of(gkz, args.shard_count) == args.shard_index),
+            "okz_with_ambiguous_streetnames": sorted(okz for okz in okz_has_ambiguous_streetnames if okz_has_ambiguous_streetnames[okz] == True),
+            "gkz_with_ambiguous_streetnames": len(gkz_has_ambiguous_streetnames),
+            "counters": counters
+        }
+        with open(os.path.join("results", shard_name + ".json"), 'w') as handle:
+            json.dump(manifest, handle, indent=2)
+        print("shard {} of {} written to results/{}.jsonl.gz".format(args.shard_index, args.shard_count, shard_name))
+    if args.metrics:
+        metrics.counters = counters
+        metrics.write(args.metrics)
+        print("metrics written to {}".format(args.metrics))
+
     # print("{:,} addresses without buildings".format(num_addresses_without_buildings))
     # print("{:,} addresses with exactly one building".format(num_addresses_with_one_building))
     # print("from which {:,} buildings have a subaddress and {:,} buildings don't".format(num_single_building_with_subadress, num_single_building_without_subadress))